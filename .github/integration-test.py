@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
 import os
+import shlex
 import subprocess
+import sys
 import time
+import uuid
+from functools import lru_cache
 from shutil import which
 
 
+@lru_cache(maxsize=1)
 def container_runtime():
+    runtime = os.environ.get("TLJH_CONTAINER_RUNTIME")
+    if runtime:
+        return runtime
     runtimes = ["docker", "podman"]
     for runtime in runtimes:
         if which(runtime):
@@ -16,7 +25,9 @@ def container_runtime():
 
 def container_check_output(*args, **kwargs):
     cmd = [container_runtime()] + list(*args)
-    print(f"Running {cmd} {kwargs}")
+    # env is left out as it would otherwise print the whole environment
+    printed_kwargs = {k: v for k, v in kwargs.items() if k != "env"}
+    print(f"Running {cmd} {printed_kwargs}")
     return subprocess.check_output(cmd, **kwargs)
 
 
@@ -26,23 +37,58 @@ def container_run(*args, **kwargs):
     return subprocess.run(cmd, **kwargs)
 
 
-def build_systemd_image(image_name, source_path, build_args=None):
+def container_stream(*args, **kwargs):
+    """
+    Run a container runtime command, writing its output to stdout as it is
+    produced instead of buffering it.
+    """
+    cmd = [container_runtime()] + list(*args)
+    print(f"Running {cmd} {kwargs}")
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=1,
+        encoding="utf-8",
+        errors="replace",
+        **kwargs,
+    )
+    with proc:
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def build_systemd_image(image_name, source_path, build_args=None, cache_from=None):
     """
     Build docker image with systemd at source_path.
 
-    Built image is tagged with image_name
+    Built image is tagged with image_name. BuildKit is enabled and cache
+    metadata is written inline in the image, so that a pushed copy of it can
+    be passed via cache_from to reuse its layers in later builds.
     """
     cmd = ["build", f"-t={image_name}", source_path]
+    cmd.append("--build-arg=BUILDKIT_INLINE_CACHE=1")
     if build_args:
         cmd.extend([f"--build-arg={ba}" for ba in build_args])
-    container_check_output(cmd)
+    if cache_from:
+        cmd.extend([f"--cache-from={cf}" for cf in cache_from])
+    env = {"DOCKER_BUILDKIT": "1", **os.environ}
+    container_check_output(cmd, env=env)
 
 
-def check_container_ready(container_name, timeout=60):
+def check_container_ready(container_name, timeout=60, max_interval=5):
     """
     Check if container is ready to run tests
+
+    Probes are retried with an exponentially increasing interval, starting
+    short and capped at max_interval seconds. Diagnostics from inspect and logs
+    are only collected once the timeout is reached.
     """
     now = time.time()
+    interval = 0.1
     while True:
         try:
             out = container_check_output(["exec", "-t", container_name, "id"])
@@ -50,19 +96,20 @@ def check_container_ready(container_name, timeout=60):
             return
         except subprocess.CalledProcessError as e:
             print(e)
-            try:
-                out = container_check_output(["inspect", container_name])
-                print(out.decode())
-            except subprocess.CalledProcessError as e:
-                print(e)
-            try:
-                out = container_check_output(["logs", container_name])
-                print(out.decode())
-            except subprocess.CalledProcessError as e:
-                print(e)
             if time.time() - now > timeout:
+                try:
+                    out = container_check_output(["inspect", container_name])
+                    print(out.decode())
+                except subprocess.CalledProcessError as e:
+                    print(e)
+                try:
+                    out = container_check_output(["logs", container_name])
+                    print(out.decode())
+                except subprocess.CalledProcessError as e:
+                    print(e)
                 raise RuntimeError(f"Container {container_name} hasn't started")
-            time.sleep(5)
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
 
 
 def run_systemd_image(image_name, container_name, bootstrap_pip_spec):
@@ -97,17 +144,98 @@ def stop_container(container_name):
     Stop & remove docker container if it exists.
     """
     try:
-        container_check_output(["inspect", container_name], stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
-        # No such container exists, nothing to do
-        return
-    container_check_output(["rm", "-f", container_name])
+        container_check_output(["rm", "-f", container_name], stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        # docker succeeds when removing a missing container, but podman fails
+        # with a "no such container" error. Nothing to do in that case, while
+        # other errors are raised.
+        if "no such container" not in e.output.decode().lower():
+            raise
 
 
-def run_container_command(container_name, cmd):
+class ContainerShell:
+    """
+    A long running bash shell inside a running container
+
+    Commands are written to the shell's stdin one at a time, and their output
+    is read back until a marker line carrying the command's exit code is seen.
+    This avoids starting a new exec session for each command.
+
+    Each command runs in its own subshell, so shell state such as the working
+    directory, exported variables or set -e doesn't carry over between them.
+    Commands don't get a TTY, so PYTHONUNBUFFERED is set to keep the output of
+    python processes unbuffered and in order.
+    """
+
+    def __init__(self, container_name):
+        self.container_name = container_name
+        self.marker = f"__TLJH_RC_{uuid.uuid4().hex}__"
+        self.proc = None
+
+    def __enter__(self):
+        cmd = [
+            container_runtime(),
+            "exec",
+            "-i",
+            "-e",
+            "PYTHONUNBUFFERED=1",
+            self.container_name,
+            "/bin/bash",
+        ]
+        print(f"Running {cmd}")
+        self.proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            encoding="utf-8",
+            errors="replace",
+            bufsize=1,
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+    def run(self, cmd):
+        """
+        Run cmd in the shell, raising CalledProcessError if it fails
+        """
+        print(f"Running {cmd!r} in {self.container_name}")
+        # cmd is eval'd in a subshell so syntax errors, exit or changes to shell
+        # state don't affect the shell, and stdin is redirected so cmd can't
+        # consume the commands that follow it
+        self.proc.stdin.write(
+            f'( eval {shlex.quote(cmd)} ) < /dev/null\necho "{self.marker}$?"\n'
+        )
+        self.proc.stdin.flush()
+        for line in self.proc.stdout:
+            if self.marker in line:
+                output, _, returncode = line.rstrip("\n").partition(self.marker)
+                sys.stdout.write(output)
+                sys.stdout.flush()
+                break
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        else:
+            raise RuntimeError(
+                f"Shell in container {self.container_name} exited while running {cmd!r}"
+            )
+        returncode = int(returncode)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def run_container_command(container_name, cmd, shell=None):
     """
     Run cmd in a running container with a bash shell
+
+    If shell is a ContainerShell, cmd is run in it instead of a new exec session.
     """
+    if shell is not None:
+        shell.run(cmd)
+        return
     proc = container_run(
         ["exec", "-t", container_name, "/bin/bash", "-c", cmd],
         check=True,
@@ -140,14 +268,31 @@ def run_test(
 
     source_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 
-    copy_to_container(test_name, os.path.join(source_path, "bootstrap/."), "/srv/src")
-    copy_to_container(
-        test_name, os.path.join(source_path, "integration-tests/"), "/srv/src"
-    )
+    # The copies are independent of each other, so they are run concurrently.
+    # /srv/src is created in the image, so they don't depend on each other's
+    # ordering.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                copy_to_container,
+                test_name,
+                os.path.join(source_path, "bootstrap/."),
+                "/srv/src",
+            ),
+            executor.submit(
+                copy_to_container,
+                test_name,
+                os.path.join(source_path, "integration-tests/"),
+                "/srv/src",
+            ),
+        ]
+        concurrent.futures.wait(futures)
+    for future in futures:
+        future.result()
 
     # These logs can be very relevant to debug a container startup failure
     print(f"--- Start of logs from the container: {test_name}")
-    print(container_check_output(["logs", test_name]).decode())
+    container_stream(["logs", test_name])
     print(f"--- End of logs from the container: {test_name}")
 
     # To test upgrades, we run a bootstrap.py script two times instead of one,
@@ -165,47 +310,55 @@ def run_test(
     #        obvious, thinking it could have been the latest released version
     #        also.
     #
-    if upgrade_from:
+    with ContainerShell(test_name) as shell:
+        if upgrade_from:
+            run_container_command(
+                test_name,
+                f"curl -L https://tljh.jupyter.org/bootstrap.py | python3 - --version={upgrade_from}",
+                shell,
+            )
         run_container_command(
-            test_name,
-            f"curl -L https://tljh.jupyter.org/bootstrap.py | python3 - --version={upgrade_from}",
+            test_name, f"python3 /srv/src/bootstrap.py {installer_args}", shell
         )
-    run_container_command(test_name, f"python3 /srv/src/bootstrap.py {installer_args}")
 
-    # Install pkgs from requirements in hub's pip, where
-    # the bootstrap script installed the others
-    run_container_command(
-        test_name,
-        "/opt/tljh/hub/bin/python3 -m pip install -r /srv/src/integration-tests/requirements.txt",
-    )
+        # Install pkgs from requirements in hub's pip, where
+        # the bootstrap script installed the others
+        run_container_command(
+            test_name,
+            "/opt/tljh/hub/bin/python3 -m pip install -r /srv/src/integration-tests/requirements.txt",
+            shell,
+        )
 
-    # show environment
-    run_container_command(
-        test_name,
-        "/opt/tljh/hub/bin/python3 -m pip freeze",
-    )
+        # show environment
+        run_container_command(
+            test_name,
+            "/opt/tljh/hub/bin/python3 -m pip freeze",
+            shell,
+        )
 
-    run_container_command(
-        test_name,
-        # We abort pytest after two failures as a compromise between wanting to
-        # avoid a flood of logs while still understanding if multiple tests
-        # would fail.
-        "/opt/tljh/hub/bin/python3 -m pytest --verbose --maxfail=2 --color=yes --durations=10 --capture=no {}".format(
-            " ".join(
-                [os.path.join("/srv/src/integration-tests/", f) for f in test_files]
-            )
-        ),
-    )
+        run_container_command(
+            test_name,
+            # We abort pytest after two failures as a compromise between wanting to
+            # avoid a flood of logs while still understanding if multiple tests
+            # would fail.
+            "/opt/tljh/hub/bin/python3 -m pytest --verbose --maxfail=2 --color=yes --durations=10 --capture=no {}".format(
+                " ".join(
+                    [os.path.join("/srv/src/integration-tests/", f) for f in test_files]
+                )
+            ),
+            shell,
+        )
 
 
 def show_logs(container_name):
     """
     Print logs from inside container to stdout
     """
-    run_container_command(container_name, "journalctl --no-pager")
-    run_container_command(
-        container_name, "systemctl --no-pager status jupyterhub traefik"
-    )
+    with ContainerShell(container_name) as shell:
+        run_container_command(container_name, "journalctl --no-pager", shell)
+        run_container_command(
+            container_name, "systemctl --no-pager status jupyterhub traefik", shell
+        )
 
 
 def main():
@@ -218,6 +371,11 @@ def main():
         action="append",
         dest="build_args",
     )
+    build_image_parser.add_argument(
+        "--cache-from",
+        action="append",
+        dest="cache_from",
+    )
 
     stop_container_parser = subparsers.add_parser("stop-container")
     stop_container_parser.add_argument("container_name")
@@ -270,7 +428,9 @@ def main():
     elif args.action == "stop-container":
         stop_container(args.container_name)
     elif args.action == "build-image":
-        build_systemd_image(image_name, "integration-tests", args.build_args)
+        build_systemd_image(
+            image_name, "integration-tests", args.build_args, args.cache_from
+        )
 
 
 if __name__ == "__main__":